@@ -1,9 +1,22 @@
 import os
+import re
+import sys
 import json
+import math
+import time
+import shutil
+import uuid
+import hmac
+import fcntl
+import hashlib
 import logging
 import tempfile
+import threading
 import subprocess
-from flask import Flask, request, jsonify
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import Flask, request, jsonify, g, has_request_context, send_file
 from flask_cors import CORS
 import yt_dlp
 from werkzeug.exceptions import BadRequest
@@ -18,69 +31,1179 @@ CORS(app)  # 允许跨域请求
 # 配置
 MAX_DURATION = 600  # 最大视频时长：10分钟
 MAX_FILESIZE = 100 * 1024 * 1024  # 最大文件大小：100MB
+SERVICE_NAME = 'railway-video-service'
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')  # 管理端点令牌，未配置时管理端点关闭
+MAX_PROFILE_SECONDS = 60  # 单次采样最长时间
+PROFILE_INTERVAL = 0.01  # 采样间隔：10ms
+SCENE_THRESHOLD = 0.3  # 场景切换阈值（ffmpeg scene score）
+KEYFRAME_WIDTH = 320  # 关键帧缩放宽度
+AUDIO_SAMPLE_RATE = 44100  # 输出音频统一采样率，串行/并行编码和无损中间文件一致
+AUDIO_CODECS = {
+    'mp3': ['-acodec', 'libmp3lame', '-ab', '192k', '-ar', str(AUDIO_SAMPLE_RATE)],  # 交付给 ASR 的格式
+    'flac': ['-acodec', 'flac', '-ar', str(AUDIO_SAMPLE_RATE)],  # 静音压缩前的无损中间格式
+}
+SILENCE_NOISE_DB = -35  # 静音判定阈值（dB）
+MIN_SILENCE = 1.0  # 超过该时长的静音才压缩（秒）
+KEEP_SILENCE = 0.3  # 压缩后每段静音保留的时长（秒），避免语句粘连
+COMPACT_FRAME_SAMPLES = 441  # 静音压缩的裁剪粒度：10ms，裁剪点和时间映射都落在该网格上
+PARALLEL_MIN_DURATION = 120  # 超过该时长才考虑并行转码（秒）
+MIN_CHUNK_SECONDS = 30  # 每个并行分段的最短时长（秒）
+MAX_TRANSCODE_WORKERS = int(os.environ.get('MAX_TRANSCODE_WORKERS', 0))  # 容器内所有 worker 同时运行的 ffmpeg 编解码进程上限，0 表示按容器可用核数
+CPU_SLOTS_DIR = os.path.join(tempfile.gettempdir(), 'video-cpu-slots')  # CPU 名额锁文件目录，须为本机目录
+CPU_SLOT_POLL_INTERVAL = 0.1  # 等待空闲名额的轮询间隔（秒）
+JOBS_DIR = os.environ.get('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'video-jobs'))  # 任务检查点目录，可挂载持久卷
+JOB_TTL = 3600  # 任务（含已完成、失败的）保留时间：1小时
+MAINTENANCE_INTERVAL = 600  # 定期清理间隔：10分钟
+MAX_JOB_ATTEMPTS = 3  # 单个任务最多自动恢复次数
+RECOVER_JOBS = os.environ.get('RECOVER_JOBS', '1') == '1'  # worker 启动时是否恢复未完成任务
+ARTIFACTS_DIR = os.environ.get('ARTIFACTS_DIR', os.path.join(tempfile.gettempdir(), 'video-artifacts'))  # 音频产物目录
+ARTIFACT_TTL = int(os.environ.get('ARTIFACT_TTL', 24 * 3600))  # 产物有效期：默认 24 小时
+
+trace_logger = logging.getLogger('trace')
+
+
+class Span:
+    """单个追踪片段，字段与 OpenTelemetry OTLP/JSON 对齐"""
+
+    def __init__(self, name, trace_id, parent_span_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, error=None):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            if error is not None:
+                self.error = str(error)
+
+    @staticmethod
+    def _attribute_value(value):
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,  # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns or time.time_ns()),
+            'attributes': [
+                {'key': k, 'value': self._attribute_value(v)}
+                for k, v in self.attributes.items()
+            ],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_span_id:
+            span['parentSpanId'] = self.parent_span_id
+        return span
+
+
+class Tracer:
+    """请求级追踪：每个请求一棵 span 树，请求结束时以 OTLP/JSON 结构输出一行日志"""
+
+    @staticmethod
+    def start_trace(name, traceparent=None, attributes=None):
+        """开始一次请求追踪，支持 W3C traceparent 透传"""
+        trace_id, parent_id = uuid.uuid4().hex, None
+        if traceparent:
+            parts = traceparent.split('-')
+            if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+                trace_id, parent_id = parts[1], parts[2]
+        root = Span(name, trace_id, parent_id, attributes)
+        g.trace_spans = [root]
+        g.trace_stack = [root]
+        return root
+
+    @staticmethod
+    def start_span(name, **attributes):
+        """开始子 span（无请求上下文时返回 None）"""
+        if not has_request_context() or not getattr(g, 'trace_stack', None):
+            return None
+        parent = g.trace_stack[-1]
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+        g.trace_spans.append(span)
+        g.trace_stack.append(span)
+        return span
+
+    @staticmethod
+    def context():
+        """当前请求的 (span 列表, 栈顶 span)，交给线程池任务挂子 span（无请求上下文时返回 None）"""
+        if not has_request_context() or not getattr(g, 'trace_stack', None):
+            return None
+        return g.trace_spans, g.trace_stack[-1]
+    
+    @staticmethod
+    def start_detached_span(context, name, **attributes):
+        """在没有请求上下文的线程里，以 context 的栈顶 span 为父开始子 span"""
+        if context is None:
+            return None
+        spans, parent = context
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+        spans.append(span)
+        return span
+
+    @staticmethod
+    def end_span(span, error=None):
+        if span is None:
+            return
+        span.end(error)
+        if not has_request_context():
+            return
+        stack = g.trace_stack
+        if span in stack:
+            del stack[stack.index(span):]
+
+    @staticmethod
+    def export():
+        """结束整棵追踪并输出结构化 JSON 日志"""
+        spans = getattr(g, 'trace_spans', None)
+        if not spans:
+            return
+        for span in spans:
+            span.end()
+        trace_logger.info(json.dumps({
+            'resourceSpans': [{
+                'resource': {'attributes': [
+                    {'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}},
+                    {'key': 'process.pid', 'value': {'intValue': str(os.getpid())}},
+                ]},
+                'scopeSpans': [{
+                    'scope': {'name': SERVICE_NAME},
+                    'spans': [span.to_otlp() for span in spans],
+                }],
+            }]
+        }, ensure_ascii=False))
+        g.trace_spans = []
+
+
+@contextmanager
+def trace_span(name, context=None, **attributes):
+    """以 with 语句包裹一段耗时操作；在线程池里执行时传入 Tracer.context() 取得的 context"""
+    if context is None:
+        span = Tracer.start_span(name, **attributes)
+    else:
+        span = Tracer.start_detached_span(context, name, **attributes)
+    try:
+        yield span
+    except Exception as e:
+        Tracer.end_span(span, e)
+        raise
+    Tracer.end_span(span)
+
+
+def redact_command_line(cmd):
+    """命令行脱敏：URL 只保留协议和主机（直链带签名），请求头和 Cookie 的值整体隐去"""
+    parts = []
+    for index, arg in enumerate(cmd):
+        if index and cmd[index - 1] in ('-headers', '-cookies'):
+            arg = '<redacted>'
+        else:
+            match = re.match(r'([a-z][a-z0-9+.-]*://)(?:[^/?#@]*@)?([^/?#]*)', arg, re.I)
+            if match:
+                arg = match.group(1) + match.group(2) + '/<redacted>'
+        parts.append(arg)
+    return ' '.join(parts)
+
+
+def run_subprocess(cmd, trace_context=None, **kwargs):
+    """带追踪的 subprocess.run"""
+    attributes = {'process.command': cmd[0], 'process.command_line': redact_command_line(cmd)}
+    with trace_span('subprocess', trace_context, **attributes) as span:
+        result = subprocess.run(cmd, **kwargs)
+        if span is not None:
+            span.set_attribute('process.exit_code', result.returncode)
+        return result
+
+
+class TraceHooks:
+    """把 yt-dlp 的下载回调转换成 span"""
+
+    def __init__(self):
+        self.download_span = None
+
+    def progress_hook(self, d):
+        status = d.get('status')
+        if status == 'downloading' and self.download_span is None:
+            self.download_span = Tracer.start_span('download.transfer', **{'file.path': d.get('filename', '')})
+        elif status in ('finished', 'error') and self.download_span is not None:
+            self.download_span.set_attribute('http.response.body.size', d.get('downloaded_bytes') or d.get('total_bytes') or 0)
+            Tracer.end_span(self.download_span, 'download error' if status == 'error' else None)
+            self.download_span = None
+
+
+class StackSampler:
+    """采样当前 worker 进程内其他线程的 Python 调用栈，输出 flamegraph 折叠格式"""
+
+    @staticmethod
+    def _fold(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    @staticmethod
+    def sample(seconds, interval=PROFILE_INTERVAL):
+        """采样 seconds 秒，返回 {折叠栈: 次数}"""
+        counts = collections.Counter()
+        own_id = threading.get_ident()
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                name = thread_names.get(thread_id, str(thread_id))
+                counts[f'{name};{StackSampler._fold(frame)}'] += 1
+            time.sleep(interval)
+        return counts
+
+class Job:
+    """可恢复的处理任务：按任务 ID 固定目录，job.json 记录检查点"""
+    
+    def __init__(self, job_id, state=None):
+        self.job_id = job_id
+        self.dir = os.path.join(JOBS_DIR, job_id)
+        self.state = state or {}
+    
+    @property
+    def media_path(self):
+        """下载/输出文件的固定前缀（.part 文件也落在这里，便于断点续传）"""
+        return os.path.join(self.dir, 'media')
+    
+    @property
+    def state_path(self):
+        return os.path.join(self.dir, 'job.json')
+    
+    @property
+    def lock_path(self):
+        """锁文件放在任务目录之外，删除任务目录时等锁的请求仍在同一把锁上"""
+        return os.path.join(JOBS_DIR, f'{self.job_id}.lock')
+    
+    @staticmethod
+    def key_for(url, options):
+        """同一 URL + 选项得到同一任务 ID，客户端重试即可接上之前的进度"""
+        payload = json.dumps({'url': url, 'options': options}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+    
+    @classmethod
+    def open(cls, url, options):
+        """打开 URL + 选项对应的任务，不存在则创建"""
+        job = cls(cls.key_for(url, options))
+        job.url, job.options = url, options
+        job.refresh()
+        return job
+    
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _new_state(self):
+        return {
+            'job_id': self.job_id,
+            'url': self.url,
+            'options': self.options,
+            'status': 'pending',
+            'stage': None,
+            'attempts': 0,
+            'created_at': time.time(),
+        }
+    
+    def refresh(self):
+        """重新读取检查点（拿到锁之后调用，目录可能已被清理）"""
+        os.makedirs(self.dir, exist_ok=True)
+        state = self._load(self.state_path)
+        if state is not None and hasattr(self, 'url'):
+            # 检查点必须属于本次请求的 URL 和选项，否则当作新任务
+            if state.get('url') != self.url or state.get('options') != json.loads(json.dumps(self.options)):
+                state = None
+        self.state = state if state is not None else self._new_state()
+    
+    def reset(self):
+        """丢弃全部中间结果，从头开始"""
+        shutil.rmtree(self.dir, ignore_errors=True)
+        os.makedirs(self.dir, exist_ok=True)
+        self.state = self._new_state()
+    
+    def checkpoint(self, **fields):
+        """原子写入检查点，进程被杀时不会留下半个 job.json"""
+        self.state.update(fields, updated_at=time.time())
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+    
+    @contextmanager
+    def lock(self, blocking=True):
+        """跨 worker 的任务锁；非阻塞模式下拿不到锁时返回 False"""
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        while True:
+            lock_file = open(self.lock_path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                lock_file.close()
+                yield False
+                return
+            # 等锁期间锁文件可能已被删除，锁住的是旧 inode 时重新打开
+            try:
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(self.lock_path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+    
+    def is_expired(self):
+        return time.time() - self.state.get('updated_at', self.state.get('created_at', 0)) > JOB_TTL
+    
+    def result_artifact(self):
+        """已完成任务的音频产物，未完成或产物已过期时返回 None"""
+        if self.state.get('status') != 'done':
+            return None
+        meta = ArtifactStore.get(self.state.get('artifact_id', ''))
+        if meta is None or meta['expires_at'] < time.time() or not os.path.exists(ArtifactStore.file_path(meta)):
+            return None
+        return meta
+    
+    def remove(self):
+        """删除任务目录和锁文件（调用方需持有锁）"""
+        shutil.rmtree(self.dir, ignore_errors=True)
+        if os.path.exists(self.lock_path):
+            os.unlink(self.lock_path)
+    
+    @classmethod
+    def all(cls):
+        """遍历磁盘上的全部任务"""
+        if not os.path.isdir(JOBS_DIR):
+            return
+        for job_id in os.listdir(JOBS_DIR):
+            state = cls._load(os.path.join(JOBS_DIR, job_id, 'job.json'))
+            if state is not None:
+                yield cls(job_id, state)
+    
+    @classmethod
+    def sweep(cls):
+        """删除过期任务（含已完成、后台恢复后未领取、失败的任务）和遗留的锁文件"""
+        for job in cls.all():
+            if not job.is_expired():
+                continue
+            with job.lock(blocking=False) as locked:
+                if not locked:
+                    continue
+                job.state = cls._load(job.state_path) or job.state
+                if job.is_expired():
+                    logger.info(f'清理过期任务: {job.job_id}')
+                    job.remove()
+        
+        now = time.time()
+        for name in os.listdir(JOBS_DIR) if os.path.isdir(JOBS_DIR) else []:
+            if not name.endswith('.lock'):
+                continue
+            job = cls(name[:-5])
+            try:
+                stale = not os.path.isdir(job.dir) and now - os.path.getmtime(job.lock_path) > JOB_TTL
+            except OSError:
+                continue
+            if stale:
+                with job.lock(blocking=False) as locked:
+                    if locked and not os.path.isdir(job.dir):
+                        os.unlink(job.lock_path)
+
+
+class ArtifactStore:
+    """处理结果的内容寻址存储：ID 为内容 SHA-256 前缀，同时作为 ETag"""
+    
+    @staticmethod
+    def path(artifact_id):
+        return os.path.join(ARTIFACTS_DIR, artifact_id)
+    
+    @staticmethod
+    def put(src_path, content_type, ext, job_id=None):
+        """把文件移入存储，返回元数据"""
+        with trace_span('artifact.put'):
+            digest = hashlib.sha256()
+            with open(src_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            artifact_id = digest.hexdigest()[:32]
+            
+            os.makedirs(ARTIFACTS_DIR, exist_ok=True)
+            now = time.time()
+            meta = {
+                'id': artifact_id,
+                'content_type': content_type,
+                'ext': ext,
+                'size': os.path.getsize(src_path),
+                'job_id': job_id,
+                'created_at': now,
+                'expires_at': now + ARTIFACT_TTL,
+            }
+            shutil.move(src_path, ArtifactStore.path(artifact_id) + '.' + ext)
+            tmp_path = ArtifactStore.path(artifact_id) + '.json.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, ArtifactStore.path(artifact_id) + '.json')
+            return meta
+    
+    @staticmethod
+    def get(artifact_id):
+        """读取元数据，不存在返回 None"""
+        if not re.fullmatch(r'[0-9a-f]{32}', artifact_id):
+            return None
+        try:
+            with open(ArtifactStore.path(artifact_id) + '.json', 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    @staticmethod
+    def file_path(meta):
+        return ArtifactStore.path(meta['id']) + '.' + meta['ext']
+    
+    @staticmethod
+    def remove(meta):
+        for path in (ArtifactStore.file_path(meta), ArtifactStore.path(meta['id']) + '.json'):
+            if os.path.exists(path):
+                os.unlink(path)
+    
+    @staticmethod
+    def cleanup():
+        """删除过期产物"""
+        if not os.path.isdir(ARTIFACTS_DIR):
+            return
+        now = time.time()
+        for name in os.listdir(ARTIFACTS_DIR):
+            if name.endswith('.json'):
+                meta = ArtifactStore.get(name[:-5])
+                if meta and meta['expires_at'] < now:
+                    logger.info(f'清理过期产物: {meta["id"]}')
+                    ArtifactStore.remove(meta)
+    
+    @staticmethod
+    def describe(meta):
+        """返回给调用方的产物句柄"""
+        return {
+            'artifact_id': meta['id'],
+            'url': f'/artifacts/{meta["id"]}',
+            'etag': meta['id'],
+            'size': meta['size'],
+            'expires_at': int(meta['expires_at']),
+        }
+
+
+class CpuSlots:
+    """同一容器内所有 worker 进程共享的 CPU 名额
+
+    每个名额是 CPU_SLOTS_DIR 下的一个 flock 文件，每个 ffmpeg 编解码进程占一个名额。
+    名额总数为 MAX_TRANSCODE_WORKERS，未配置时取容器可用核数；进程退出时内核自动释放锁。
+    """
+    
+    @staticmethod
+    def available_cpus():
+        """容器实际可用的核数：CPU 亲和性与 cgroup 配额取小"""
+        try:
+            cpus = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cpus = os.cpu_count() or 1
+        
+        quota = None
+        try:
+            with open('/sys/fs/cgroup/cpu.max') as f:  # cgroup v2: "<quota> <period>" 或 "max <period>"
+                limit, period = f.read().split()
+            if limit != 'max':
+                quota = int(limit) / int(period)
+        except (OSError, ValueError):
+            try:  # cgroup v1
+                with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                    limit = int(f.read())
+                with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                    period = int(f.read())
+                if limit > 0:
+                    quota = limit / period
+            except (OSError, ValueError):
+                pass
+        
+        if quota is not None:
+            cpus = min(cpus, max(1, int(quota)))
+        return cpus
+    
+    @staticmethod
+    def capacity():
+        return MAX_TRANSCODE_WORKERS or CpuSlots.available_cpus()
+    
+    @staticmethod
+    def try_acquire(count):
+        """非阻塞地申请最多 count 个名额，返回持有的文件描述符列表"""
+        os.makedirs(CPU_SLOTS_DIR, exist_ok=True)
+        slots = []
+        for index in range(CpuSlots.capacity()):
+            if len(slots) >= count:
+                break
+            fd = os.open(os.path.join(CPU_SLOTS_DIR, f'{index}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                slots.append(fd)
+            except BlockingIOError:
+                os.close(fd)
+        return slots
+    
+    @staticmethod
+    def release(slots):
+        for fd in slots:
+            os.close(fd)  # 关闭即释放 flock
+    
+    @staticmethod
+    @contextmanager
+    def hold():
+        """占一个名额运行 ffmpeg；名额用完时排队等待，不超卖 CPU"""
+        slots = CpuSlots.try_acquire(1)
+        if not slots:
+            with trace_span('cpu.wait'):
+                while not slots:
+                    time.sleep(CPU_SLOT_POLL_INTERVAL)
+                    slots = CpuSlots.try_acquire(1)
+        try:
+            yield
+        finally:
+            CpuSlots.release(slots)
+
+
+class ParallelTranscoder:
+    """把长音频按时间切段，多个 ffmpeg 进程并行编码 MP3，再按帧边界无损拼接
+
+    MP3 每帧 1152 个采样。各段关闭比特池（-reservoir 0）后帧之间互不依赖，可以直接
+    按字节拼接。每段从分段起点前 PREROLL 个采样开始编码，PREROLL 加上 LAME 的编解码
+    延迟正好是 2 帧，丢掉前 2 帧后所有分段都对齐到同一条帧网格上。
+    """
+    
+    SAMPLE_RATE = AUDIO_SAMPLE_RATE
+    FRAME_SAMPLES = 1152
+    LAME_DELAY = 576 + 529  # 编码器延迟 + 解码器延迟（采样）
+    LEAD_FRAMES = 2
+    PREROLL = LEAD_FRAMES * FRAME_SAMPLES - LAME_DELAY
+    BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]  # MPEG-1 Layer III，kbps
+    SAMPLE_RATES = [44100, 48000, 32000]
+    
+    @staticmethod
+    def reserve_workers(duration):
+        """从共享 CPU 名额中非阻塞地申请并行度，返回持有的名额；不足 2 个时返回空列表，走串行"""
+        if not duration or duration < PARALLEL_MIN_DURATION:
+            return []
+        slots = CpuSlots.try_acquire(int(duration // MIN_CHUNK_SECONDS))
+        if len(slots) < 2:
+            CpuSlots.release(slots)
+            return []
+        return slots
+    
+    @staticmethod
+    def probe_duration(path):
+        """用 ffprobe 读取精确时长"""
+        result = run_subprocess([
+            'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+            '-of', 'default=noprint_wrappers=1:nokey=1', path,
+        ], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f'ffprobe 失败: {result.stderr[-500:]}')
+        return float(result.stdout.strip())
+    
+    @staticmethod
+    def split_frames(data):
+        """把不带 ID3/Xing 头的 MPEG-1 Layer III 流切成帧"""
+        frames, pos = [], 0
+        while pos + 4 <= len(data):
+            header = int.from_bytes(data[pos:pos + 4], 'big')
+            if header >> 21 != 0x7ff or (header >> 19) & 3 != 3 or (header >> 17) & 3 != 1:
+                raise ValueError(f'无效的 MP3 帧头: offset {pos}')
+            bitrate = ParallelTranscoder.BITRATES[(header >> 12) & 0xf] * 1000
+            sample_rate = ParallelTranscoder.SAMPLE_RATES[(header >> 10) & 3]
+            size = 144 * bitrate // sample_rate + ((header >> 9) & 1)
+            frames.append(data[pos:pos + size])
+            pos += size
+        return frames
+    
+    @staticmethod
+    def encode_chunk(source_path, chunk_path, first_frame, frame_count, bitrate, trace_context=None):
+        """编码一个分段，返回对齐后的 frame_count 帧"""
+        cls = ParallelTranscoder
+        start_sample = first_frame * cls.FRAME_SAMPLES
+        if start_sample:
+            seek_args = ['-ss', f'{(start_sample - cls.PREROLL) / cls.SAMPLE_RATE:.6f}']
+            filter_args = []
+        else:
+            # 第一段前面没有数据可作预卷，补等长静音（先重采样，采样数才按输出采样率计）
+            seek_args = []
+            filter_args = ['-af', f'aresample={cls.SAMPLE_RATE},adelay={cls.PREROLL}S:all=1']
+        
+        # 多编 1 帧，保证最后保留的帧完整
+        output_seconds = (cls.LEAD_FRAMES + frame_count + 1) * cls.FRAME_SAMPLES / cls.SAMPLE_RATE
+        ffmpeg_cmd = ['ffmpeg', '-hide_banner', '-nostats'] + seek_args + ['-i', source_path] + filter_args + [
+            '-vn', '-ar', str(cls.SAMPLE_RATE),
+            '-acodec', 'libmp3lame', '-b:a', bitrate, '-reservoir', '0',
+            '-t', f'{output_seconds:.6f}',
+            '-write_xing', '0', '-id3v2_version', '0', '-f', 'mp3',
+            '-y', chunk_path,
+        ]
+        
+        result = run_subprocess(ffmpeg_cmd, trace_context, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f'FFmpeg 分段编码失败: {result.stderr[-500:]}')
+        with open(chunk_path, 'rb') as f:
+            frames = ParallelTranscoder.split_frames(f.read())
+        os.unlink(chunk_path)
+        return frames[cls.LEAD_FRAMES:cls.LEAD_FRAMES + frame_count]
+    
+    @staticmethod
+    def transcode(source_path, audio_path, workers, bitrate='192k'):
+        """并行转码，输出时长与串行编码一致（精确到一帧）"""
+        cls = ParallelTranscoder
+        duration = cls.probe_duration(source_path)
+        total_frames = -(-int(round(duration * cls.SAMPLE_RATE)) // cls.FRAME_SAMPLES)
+        per_chunk = -(-total_frames // workers)
+        chunks = [
+            (first, min(per_chunk, total_frames - first))
+            for first in range(0, total_frames, per_chunk)
+        ]
+        
+        with trace_span('transcode.parallel', **{'transcode.workers': len(chunks), 'media.duration': duration}):
+            # 线程池没有请求上下文，先取出父 span，每个分段记录一个子 span
+            trace_context = Tracer.context()
+            with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+                futures = [
+                    pool.submit(cls.encode_chunk, source_path, f'{audio_path}.chunk{index}',
+                                first, count, bitrate, trace_context)
+                    for index, (first, count) in enumerate(chunks)
+                ]
+                results = [future.result() for future in futures]
+            
+            with open(audio_path, 'wb') as f:
+                for frames in results:
+                    f.writelines(frames)
+        
+        logger.info(f'并行转码完成: {duration:.1f}秒, {len(chunks)} 段, {sum(map(len, results))}/{total_frames} 帧')
+        return audio_path
+
 
 class VideoProcessor:
     """视频处理核心类"""
     
     @staticmethod
-    def extract_video_info(url):
+    def extract_video_info(url, window=None):
         """提取视频信息"""
+        video_info, _ = VideoProcessor.resolve_media(url, 'best[ext=mp4]/best', window)
+        return video_info
+    
+    @staticmethod
+    def resolve_media(url, fmt, window=None):
+        """提取视频信息并解析所选格式的媒体直链；指定时间窗口时只校验窗口长度"""
         ydl_opts = {
             'quiet': True,
             'no_warnings': True,
             'extract_flat': False,
-            'format': 'best[ext=mp4]/best',
+            'format': fmt,
         }
         
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            with trace_span('extract', **{'url.full': url}), yt_dlp.YoutubeDL(ydl_opts) as ydl:
                 info = ydl.extract_info(url, download=False)
                 
                 # 检查视频时长
                 duration = info.get('duration', 0)
-                if duration > MAX_DURATION:
-                    raise ValueError(f'视频时长超过限制：{duration}秒 > {MAX_DURATION}秒')
+                if window is not None:
+                    start, end = window
+                    if duration and start >= duration:
+                        raise BadRequest(f'起始时间超出视频时长：{start}秒 >= {duration}秒')
+                    if duration:
+                        end = min(end, duration)
+                    if end - start > MAX_DURATION:
+                        raise BadRequest(f'时间窗口超过限制：{end - start}秒 > {MAX_DURATION}秒')
+                elif duration > MAX_DURATION:
+                    raise BadRequest(f'视频时长超过限制：{duration}秒 > {MAX_DURATION}秒，可通过 start/end 截取片段')
                 
-                return {
+                video_info = {
                     'title': info.get('title', 'Unknown'),
                     'duration': duration,
                     'uploader': info.get('uploader', 'Unknown'),
                     'view_count': info.get('view_count', 0),
                     'like_count': info.get('like_count', 0),
-                    'description': info.get('description', '')[:200],  # 只取前200字符
+                    'description': (info.get('description') or '')[:200],  # 只取前200字符
+                }
+                if window is not None:
+                    video_info['window'] = {'start': start, 'end': end}
+                
+                media = {
+                    'url': info.get('url'),
+                    'http_headers': info.get('http_headers') or {},
+                    # 提取过程中设置的 Cookie 不在 http_headers 里，按 yt-dlp 自带 ffmpeg 下载器的格式交给 ffmpeg
+                    'cookies': VideoProcessor.ffmpeg_cookies(ydl, info.get('url')),
                 }
+                return video_info, media
         except Exception as e:
             logger.error(f'提取视频信息失败: {str(e)}')
             raise
     
     @staticmethod
-    def download_and_extract_audio(url, output_path):
+    def ffmpeg_cookies(ydl, media_url):
+        """把 cookiejar 中适用于媒体直链的 Cookie 转成 ffmpeg -cookies 参数值"""
+        if not media_url or not re.match(r'https?://', media_url):
+            return ''
+        return ''.join(
+            f'{cookie.name}={cookie.value}; path={cookie.path}; domain={cookie.domain};\r\n'
+            for cookie in ydl.cookiejar.get_cookies_for_url(media_url)
+        )
+    
+    @staticmethod
+    def seek_input_args(media, window):
+        """ffmpeg 输入参数：对媒体直链做输入端 seek，HTTP 源只按 Range 读取窗口所需字节"""
+        if not media.get('url'):
+            raise ValueError('无法解析媒体直链')
+        headers = ''.join(f'{k}: {v}\r\n' for k, v in media['http_headers'].items())
+        args = ['-headers', headers] if headers else []
+        if media.get('cookies'):
+            args += ['-cookies', media['cookies']]
+        return args + [
+            '-seekable', '1',
+            '-ss', str(window['start']),
+            '-t', str(window['end'] - window['start']),
+            '-i', media['url'],
+        ]
+    
+    @staticmethod
+    def check_ffmpeg_result(result, audio_path):
+        """检查 ffmpeg 输出；输入能打开但没有音轨时返回明确的客户端错误"""
+        if result.returncode == 0 and os.path.exists(audio_path):
+            return
+        streams = re.findall(r'Stream #0:\d+.*?: (\w+):', result.stderr)
+        if streams and 'Audio' not in streams:
+            raise BadRequest('视频没有音轨，无法提取音频')
+        raise RuntimeError(f'FFmpeg 处理失败: {result.stderr[-500:]}')
+    
+    @staticmethod
+    def transcode_audio(input_args, output_path, codec='mp3'):
+        """把 ffmpeg 输入转为 ASR 用 MP3（或静音压缩用的无损 FLAC）"""
+        audio_path = f'{output_path}.{codec}'
+        ffmpeg_cmd = ['ffmpeg', '-hide_banner', '-nostats'] + input_args + ['-vn'] + AUDIO_CODECS[codec] + [
+            '-y', audio_path,
+        ]
+        
+        with CpuSlots.hold():
+            result = run_subprocess(ffmpeg_cmd, capture_output=True, text=True)
+        VideoProcessor.check_ffmpeg_result(result, audio_path)
+        return audio_path
+    
+    @staticmethod
+    def download_and_extract_audio(url, output_path, duration=0, codec='mp3'):
         """下载视频并提取音频"""
+        hooks = TraceHooks()
         ydl_opts = {
             'format': 'bestaudio/best',
+            'outtmpl': output_path + '.src.%(ext)s',
+            'quiet': True,
+            'no_warnings': True,
+            'continuedl': True,  # 存在 .part 时用 HTTP Range 从断点继续
+            'retries': 3,
+            'progress_hooks': [hooks.progress_hook],
+        }
+        
+        try:
+            with trace_span('download', **{'url.full': url}), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(url, download=True)
+                source_path = ydl.prepare_filename(info)
+                if not os.path.exists(source_path):
+                    raise FileNotFoundError('音频下载失败')
+            
+            # 返回生成的音频文件路径
+            if codec == 'mp3':
+                audio_path = VideoProcessor.encode_mp3(source_path, output_path, duration or info.get('duration', 0))
+            else:
+                audio_path = VideoProcessor.transcode_audio(['-i', source_path], output_path, codec)
+            os.unlink(source_path)
+            return audio_path
+        except Exception as e:
+            logger.error(f'下载和提取音频失败: {str(e)}')
+            raise
+    
+    @staticmethod
+    def encode_mp3(source_path, output_path, duration):
+        """把本地音频编码为 MP3：长音频且有空闲核心时并行编码，否则串行"""
+        slots = ParallelTranscoder.reserve_workers(duration)
+        if slots:
+            try:
+                return ParallelTranscoder.transcode(source_path, output_path + '.mp3', len(slots))
+            except Exception as e:
+                logger.warning(f'并行转码失败，改为串行: {str(e)}')
+            finally:
+                CpuSlots.release(slots)
+        return VideoProcessor.transcode_audio(['-i', source_path], output_path)
+    
+    @staticmethod
+    def download_video(url, output_path):
+        """下载完整视频（音视频合一），用于场景分析"""
+        hooks = TraceHooks()
+        ydl_opts = {
+            'format': 'best[ext=mp4][height<=720]/best[height<=720]/best',
             'outtmpl': output_path + '.%(ext)s',
             'quiet': True,
             'no_warnings': True,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
+            'continuedl': True,
+            'retries': 3,
+            'progress_hooks': [hooks.progress_hook],
         }
         
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-                
-                # 返回生成的 mp3 文件路径
-                mp3_path = output_path + '.mp3'
-                if os.path.exists(mp3_path):
-                    return mp3_path
+            with trace_span('download', **{'url.full': url}), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(url, download=True)
+                video_path = ydl.prepare_filename(info)
+                if os.path.exists(video_path):
+                    return video_path
                 else:
-                    raise FileNotFoundError('音频提取失败')
+                    raise FileNotFoundError('视频下载失败')
         except Exception as e:
-            logger.error(f'下载和提取音频失败: {str(e)}')
+            logger.error(f'下载视频失败: {str(e)}')
             raise
+    
+    @staticmethod
+    def extract_audio_and_scenes(input_args, output_path, duration, threshold=SCENE_THRESHOLD, offset=0, codec='mp3'):
+        """一次解码同时输出音频、场景切换时间点和每个场景的缩略关键帧
+
+        offset 为输入 seek 的起点，场景时间会加上它以对齐原视频时间轴。
+        """
+        audio_path = f'{output_path}.{codec}'
+        frames_dir = output_path + '_frames'
+        os.makedirs(frames_dir, exist_ok=True)
+        
+        ffmpeg_cmd = ['ffmpeg', '-hide_banner', '-nostats'] + input_args + [
+            '-filter_complex',
+            f"[0:v]select='eq(n,0)+gt(scene,{threshold})',showinfo,scale={KEYFRAME_WIDTH}:-2[kf]",
+            # 输出 1：ASR 音频
+            '-map', '0:a:0', *AUDIO_CODECS[codec],
+            audio_path,
+            # 输出 2：每个场景的首帧
+            '-map', '[kf]', '-vsync', 'vfr', '-q:v', '4',
+            os.path.join(frames_dir, 'scene_%04d.jpg'),
+            '-y',
+        ]
+        
+        with CpuSlots.hold():
+            result = run_subprocess(ffmpeg_cmd, capture_output=True, text=True)
+        VideoProcessor.check_ffmpeg_result(result, audio_path)
+        
+        # showinfo 按输出顺序打印被选中帧的时间戳
+        starts = [
+            offset + float(match.group(1))
+            for line in result.stderr.splitlines() if 'Parsed_showinfo' in line
+            for match in [re.search(r'pts_time:\s*([\d.]+)', line)] if match
+        ]
+        frames = sorted(os.listdir(frames_dir))
+        
+        scenes = []
+        for index, (start, frame) in enumerate(zip(starts, frames)):
+            end = starts[index + 1] if index + 1 < len(starts) else (duration or start)
+            scenes.append({
+                'index': index,
+                'start': round(start, 3),
+                'end': round(end, 3),
+                'keyframe_path': os.path.join(frames_dir, frame),
+            })
+        
+        return audio_path, scenes, frames_dir
+
+    
+    @staticmethod
+    def flac_total_samples(path):
+        """读取 FLAC STREAMINFO 中的总采样数（未知时返回 0）"""
+        with open(path, 'rb') as f:
+            head = f.read(26)
+        if len(head) < 26 or head[:4] != b'fLaC':
+            return 0
+        # STREAMINFO 第 10-17 字节：采样率(20) 声道(3) 位深(5) 总采样数(36)
+        return int.from_bytes(head[18:26], 'big') & ((1 << 36) - 1)
+    
+    @staticmethod
+    def detect_silences(audio_path, noise_db=SILENCE_NOISE_DB, min_silence=MIN_SILENCE):
+        """检测无损音频中的非语音区间，返回 (总采样数, [(开始秒, 结束秒), ...])"""
+        ffmpeg_cmd = [
+            'ffmpeg', '-hide_banner', '-nostats',
+            '-i', audio_path,
+            # 只看人声频段，减少低频底噪/高频噪声对静音判定的干扰
+            '-af', f'highpass=f=200,lowpass=f=3000,silencedetect=n={noise_db}dB:d={min_silence}',
+            '-f', 'null', '-',
+        ]
+        
+        with CpuSlots.hold():
+            result = run_subprocess(ffmpeg_cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f'FFmpeg 静音检测失败: {result.stderr[-500:]}')
+        
+        total_samples = VideoProcessor.flac_total_samples(audio_path)
+        if not total_samples:
+            match = re.search(r'Duration:\s*(\d+):(\d+):([\d.]+)', result.stderr)
+            if not match:
+                raise RuntimeError('无法获取音频时长')
+            seconds = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+            total_samples = round(seconds * AUDIO_SAMPLE_RATE)
+        duration = total_samples / AUDIO_SAMPLE_RATE
+        
+        silences, start = [], None
+        for line in result.stderr.splitlines():
+            match = re.search(r'silence_(start|end):\s*(-?[\d.]+)', line)
+            if not match:
+                continue
+            if match.group(1) == 'start':
+                start = max(0.0, float(match.group(2)))
+            elif start is not None:
+                silences.append((start, float(match.group(2))))
+                start = None
+        if start is not None:  # 静音持续到结尾
+            silences.append((start, duration))
+        
+        return total_samples, silences
+    
+    @staticmethod
+    def compact_silences(audio_path, output_path, total_samples, silences, keep=KEEP_SILENCE, offset=0):
+        """把长静音压缩到约 keep 秒，输出无损 FLAC 和时间映射表
+
+        先用 asetnsamples 把音频切成固定 COMPACT_FRAME_SAMPLES 的帧，再按帧号 aselect，
+        裁剪点和映射表都取自同一组整数帧边界，不会随裁剪次数累积误差。
+        映射表每项为压缩音频中的 [start, end) 与其在原视频中的起点 source_start，
+        转写时间戳 t 对应原视频时间 source_start + (t - start)。
+        """
+        frame = COMPACT_FRAME_SAMPLES
+        total_frames = -(-total_samples // frame)
+        
+        # 保留区间（帧号，左闭右开）= 全长去掉每段静音的中间部分（两端各留 keep/2）
+        segments, cursor = [], 0
+        for start, end in silences:
+            cut_start = round((start + keep / 2) * AUDIO_SAMPLE_RATE / frame)
+            cut_end = min(round((end - keep / 2) * AUDIO_SAMPLE_RATE / frame), total_frames)
+            if cut_end <= cut_start:
+                continue
+            if cut_start > cursor:
+                segments.append((cursor, cut_start))
+            cursor = max(cursor, cut_end)
+        if cursor < total_frames:
+            segments.append((cursor, total_frames))
+        
+        time_map, position = [], 0
+        for first, last in segments:
+            samples = min(last * frame, total_samples) - first * frame
+            time_map.append({
+                'start': round(position / AUDIO_SAMPLE_RATE, 3),
+                'end': round((position + samples) / AUDIO_SAMPLE_RATE, 3),
+                'source_start': round(offset + first * frame / AUDIO_SAMPLE_RATE, 3),
+            })
+            position += samples
+        
+        compact_path = output_path + '.flac'
+        expression = '+'.join(f'between(n,{first},{last - 1})' for first, last in segments) or '0'
+        ffmpeg_cmd = [
+            'ffmpeg', '-hide_banner', '-nostats',
+            '-i', audio_path,
+            '-af', f"asetnsamples=n={frame}:p=0,aselect='{expression}',asetpts=N/SR/TB",
+            *AUDIO_CODECS['flac'],
+            '-y', compact_path,
+        ]
+        
+        with CpuSlots.hold():
+            result = run_subprocess(ffmpeg_cmd, capture_output=True, text=True)
+        if result.returncode != 0 or not os.path.exists(compact_path):
+            raise RuntimeError(f'FFmpeg 静音压缩失败: {result.stderr[-500:]}')
+        
+        return compact_path, time_map
+
+def parse_window(data):
+    """解析时间窗口参数：start/end（秒）或 first_seconds，未指定返回 None"""
+    if not any(key in data for key in ('start', 'end', 'first_seconds')):
+        return None
+    try:
+        if 'first_seconds' in data:
+            start, end = 0.0, float(data['first_seconds'])
+        else:
+            start = float(data.get('start', 0))
+            end = float(data['end']) if 'end' in data else start + MAX_DURATION
+    except (TypeError, ValueError):
+        raise BadRequest('Invalid time window')
+    if not (math.isfinite(start) and math.isfinite(end)) or start < 0 or end <= start:
+        raise BadRequest('Invalid time window')
+    if end - start > MAX_DURATION:
+        raise BadRequest(f'Time window exceeds {MAX_DURATION} seconds')
+    return [start, end]
+
+
+def process_job(job):
+    """按检查点推进任务，已完成的阶段直接复用磁盘上的结果"""
+    state = job.state
+    url = state['url']
+    options = state.get('options', {})
+    job.checkpoint(status='running', attempts=state.get('attempts', 0) + 1)
+    
+    window = options.get('window')
+    media_format = 'best[ext=mp4][height<=720]/best[height<=720]/best' if options.get('scenes') else 'bestaudio/best'
+    media = None  # 媒体直链带签名会过期，不写入检查点
+    # 需要静音压缩时先产出无损中间文件，压缩后只做一次 MP3 编码
+    codec = 'flac' if options.get('compact_silence') else 'mp3'
+    
+    # 1. 提取视频信息
+    video_info = state.get('video_info')
+    if video_info is None:
+        if window:
+            video_info, media = VideoProcessor.resolve_media(url, media_format, window)
+        else:
+            video_info = VideoProcessor.extract_video_info(url)
+        job.checkpoint(stage='info', video_info=video_info)
+    logger.info(f'视频信息: {video_info["title"]} ({video_info["duration"]}秒)')
+    
+    # 2. 下载并提取音频（scenes=true 时下载视频，一次解码同时得到音频、场景和关键帧）
+    if state.get('stage') == 'processed' and os.path.exists(state.get('audio_path') or ''):
+        logger.info(f'复用任务 {job.job_id} 的处理结果')
+    elif window:
+        # 时间窗口：直接对媒体直链 seek，只拉取并转码窗口内的数据
+        if media is None:
+            _, media = VideoProcessor.resolve_media(url, media_format, window)
+        window = video_info['window']
+        input_args = VideoProcessor.seek_input_args(media, window)
+        if options.get('scenes'):
+            audio_path, scenes, _ = VideoProcessor.extract_audio_and_scenes(
+                input_args, job.media_path, window['end'],
+                options.get('scene_threshold', SCENE_THRESHOLD), offset=window['start'], codec=codec)
+            job.checkpoint(stage='processed', audio_path=audio_path, scenes=scenes)
+        else:
+            audio_path = VideoProcessor.transcode_audio(input_args, job.media_path, codec)
+            job.checkpoint(stage='processed', audio_path=audio_path)
+    elif options.get('scenes'):
+        video_path = VideoProcessor.download_video(url, job.media_path)
+        job.checkpoint(stage='downloaded')
+        audio_path, scenes, _ = VideoProcessor.extract_audio_and_scenes(
+            ['-i', video_path], job.media_path, video_info['duration'],
+            options.get('scene_threshold', SCENE_THRESHOLD), codec=codec)
+        os.unlink(video_path)
+        job.checkpoint(stage='processed', audio_path=audio_path, scenes=scenes)
+    else:
+        audio_path = VideoProcessor.download_and_extract_audio(url, job.media_path, video_info['duration'], codec)
+        job.checkpoint(stage='processed', audio_path=audio_path)
+    
+    # 3. 可选：在无损音频上压缩长静音，再编码为 MP3，附带时间映射表供转写时间戳回映
+    if options.get('compact_silence') and state.get('time_map') is None:
+        offset = video_info['window']['start'] if window else 0
+        source_path = state['audio_path']
+        with trace_span('silence.compact'):
+            total_samples, silences = VideoProcessor.detect_silences(
+                source_path, options.get('silence_db', SILENCE_NOISE_DB),
+                options.get('min_silence', MIN_SILENCE))
+            compact_path, time_map = VideoProcessor.compact_silences(
+                source_path, job.media_path + '_compact', total_samples, silences,
+                options.get('keep_silence', KEEP_SILENCE), offset)
+        compact_duration = time_map[-1]['end'] if time_map else 0
+        audio_path = VideoProcessor.encode_mp3(compact_path, job.media_path, compact_duration)
+        logger.info(f'静音压缩: {total_samples / AUDIO_SAMPLE_RATE:.1f}秒 -> {compact_duration}秒')
+        job.checkpoint(audio_path=audio_path, original_duration=round(total_samples / AUDIO_SAMPLE_RATE, 3),
+                       time_map=time_map)
+        os.unlink(compact_path)
+        os.unlink(source_path)
+    
+    job.checkpoint(status='ready')
+    return video_info, state['audio_path'], state.get('scenes')
+
+
+def recover_jobs():
+    """worker 启动时接着跑上次被中断的任务"""
+    for job in Job.all():
+        if job.is_expired():
+            continue  # 交给定期清理
+        if job.state.get('status') != 'running' or job.state.get('attempts', 0) >= MAX_JOB_ATTEMPTS:
+            continue
+        with job.lock(blocking=False) as locked:
+            if not locked:
+                continue  # 其他 worker 正在处理
+            job.state = Job._load(job.state_path) or {}
+            if job.state.get('status') != 'running':
+                continue
+            logger.info(f'恢复未完成任务: {job.job_id} (阶段: {job.state.get("stage")})')
+            try:
+                process_job(job)
+            except BadRequest as e:
+                logger.info(f'任务无法处理，删除 {job.job_id}: {str(e)}')
+                job.remove()
+            except Exception as e:
+                logger.error(f'恢复任务失败 {job.job_id}: {str(e)}')
+                job.checkpoint(status='failed', error=str(e))
+
+
+def run_maintenance():
+    """定期清理过期任务和产物（worker 启动时立即执行一次）"""
+    while True:
+        try:
+            Job.sweep()
+            ArtifactStore.cleanup()
+        except Exception as e:
+            logger.error(f'定期清理失败: {str(e)}')
+        time.sleep(MAINTENANCE_INTERVAL)
+
+@app.before_request
+def begin_trace():
+    """为每个请求开启追踪"""
+    g.request_start = time.monotonic()
+    Tracer.start_trace(f'{request.method} {request.path}',
+                       traceparent=request.headers.get('traceparent'),
+                       attributes={'http.request.method': request.method, 'url.path': request.path})
+
+
+@app.after_request
+def finish_trace(response):
+    """回写 traceparent 与 Server-Timing，便于调用方关联"""
+    spans = getattr(g, 'trace_spans', None)
+    if spans:
+        root = spans[0]
+        root.set_attribute('http.response.status_code', response.status_code)
+        if response.status_code >= 500 and root.error is None:
+            root.error = f'HTTP {response.status_code}'
+        response.headers['traceparent'] = f'00-{root.trace_id}-{root.span_id}-01'
+        response.headers['Server-Timing'] = f'total;dur={(time.monotonic() - g.request_start) * 1000:.1f}'
+    return response
+
+
+@app.teardown_request
+def export_trace(error=None):
+    """请求结束时导出追踪日志"""
+    spans = getattr(g, 'trace_spans', None)
+    if spans and error is not None:
+        spans[0].end(error)
+    Tracer.export()
+
+
+def require_admin():
+    """校验管理令牌（Authorization: Bearer <ADMIN_TOKEN>）"""
+    if not ADMIN_TOKEN:
+        return jsonify({'success': False, 'error': 'Admin endpoints disabled'}), 404
+    auth = request.headers.get('Authorization', '')
+    token = auth[7:] if auth.startswith('Bearer ') else ''
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    return None
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -90,8 +1213,8 @@ def health_check():
         yt_dlp_version = yt_dlp.version.__version__
         
         # 检查 ffmpeg
-        ffmpeg_result = subprocess.run(['ffmpeg', '-version'], 
-                                     capture_output=True, text=True)
+        ffmpeg_result = run_subprocess(['ffmpeg', '-version'],
+                                       capture_output=True, text=True)
         ffmpeg_available = ffmpeg_result.returncode == 0
         
         return jsonify({
@@ -118,48 +1241,96 @@ def process_video():
         url = data['url']
         logger.info(f'开始处理视频: {url}')
         
-        # 1. 提取视频信息
-        video_info = VideoProcessor.extract_video_info(url)
-        logger.info(f'视频信息: {video_info["title"]} ({video_info["duration"]}秒)')
+        with trace_span('url.check', **{'url.full': url}):
+            if not isinstance(url, str) or not url.startswith(('http://', 'https://')):
+                raise BadRequest('Invalid url')
         
-        # 2. 创建临时文件
-        with tempfile.NamedTemporaryFile(delete=False, suffix='') as tmp_file:
-            temp_path = tmp_file.name
+        options = {'scenes': bool(data.get('scenes'))}
+        if options['scenes']:
+            try:
+                options['scene_threshold'] = float(data.get('scene_threshold', SCENE_THRESHOLD))
+            except (TypeError, ValueError):
+                raise BadRequest('Invalid scene_threshold')
+            if not 0 < options['scene_threshold'] < 1:
+                raise BadRequest('scene_threshold must be between 0 and 1')
+        window = parse_window(data)
+        if window is not None:
+            options['window'] = window
+        if data.get('compact_silence'):
+            options['compact_silence'] = True
+            try:
+                for key in ('silence_db', 'min_silence', 'keep_silence'):
+                    if key in data:
+                        options[key] = float(data[key])
+            except (TypeError, ValueError):
+                raise BadRequest('Invalid silence options')
+            silence_db = options.get('silence_db', SILENCE_NOISE_DB)
+            keep_silence = options.get('keep_silence', KEEP_SILENCE)
+            if not all(math.isfinite(options.get(key, 0)) for key in ('silence_db', 'min_silence', 'keep_silence')):
+                raise BadRequest('Invalid silence options')
+            if silence_db > 0:
+                raise BadRequest('silence_db must not be positive')
+            if keep_silence < 0:
+                raise BadRequest('keep_silence must not be negative')
+            if options.get('min_silence', MIN_SILENCE) <= keep_silence:
+                raise BadRequest('min_silence must be greater than keep_silence')
+        job = Job.open(url, options)
         
-        try:
-            # 3. 下载并提取音频
-            audio_path = VideoProcessor.download_and_extract_audio(url, temp_path)
-            
-            # 4. 读取音频文件（用于返回）
-            with open(audio_path, 'rb') as f:
-                audio_data = f.read()
-            
-            # 5. 获取文件大小
-            file_size = os.path.getsize(audio_path)
-            
-            # 6. 清理临时文件
-            os.unlink(audio_path)
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
+        # 同一任务同时只允许一个 worker 处理；后来的请求等锁，拿到锁后直接复用已完成的结果
+        with job.lock():
+            job.refresh()
+            artifact = job.result_artifact()
+            if artifact is not None:
+                logger.info(f'复用已完成任务 {job.job_id} 的结果')
+            else:
+                if job.state.get('status') == 'done':
+                    job.reset()  # 产物已过期，重新处理
+                try:
+                    process_job(job)
+                except BadRequest:
+                    job.remove()  # 输入本身无法处理，重试也不会成功，不保留检查点
+                    raise
+                except Exception as e:
+                    job.checkpoint(status='failed', error=str(e))  # 保留 .part 等中间文件，重试时续传
+                    raise
+                
+                # 3. 音频存为可寻址产物，任务标记完成（保留到过期，供重试和等待中的请求复用）
+                artifact = ArtifactStore.put(job.state['audio_path'], 'audio/mpeg', 'mp3', job_id=job.job_id)
+                job.checkpoint(status='done', stage='done', audio_path=None, artifact_id=artifact['id'])
             
-            # 7. 返回结果
-            return jsonify({
-                'success': True,
-                'video_info': video_info,
-                'audio': {
-                    'size': file_size,
-                    'format': 'mp3',
-                    'data': audio_data.hex()  # 转为十六进制字符串传输
-                }
-            })
+            video_info = job.state['video_info']
+            scenes = job.state.get('scenes')
             
-        except Exception as e:
-            # 清理临时文件
-            if 'audio_path' in locals() and os.path.exists(audio_path):
-                os.unlink(audio_path)
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
-            raise e
+            # 4. 读取关键帧
+            if scenes is not None:
+                with trace_span('keyframes.read', **{'scene.count': len(scenes)}):
+                    scenes = [dict(scene) for scene in scenes]
+                    for scene in scenes:
+                        with open(scene.pop('keyframe_path'), 'rb') as f:
+                            scene['keyframe'] = {'format': 'jpeg', 'data': f.read().hex()}
+        
+        # 5. 返回结果（artifact=true 时只返回产物句柄，由调用方按需 GET /artifacts/<id>）
+        audio = {'format': 'mp3', **ArtifactStore.describe(artifact)}
+        file_size = artifact['size']
+        if not data.get('artifact'):
+            with trace_span('audio.read'):
+                with open(ArtifactStore.file_path(artifact), 'rb') as f:
+                    audio['data'] = f.read().hex()  # 转为十六进制字符串传输
+        
+        result = {
+            'success': True,
+            'job_id': job.job_id,
+            'video_info': video_info,
+            'audio': audio,
+        }
+        if scenes is not None:
+            result['scenes'] = scenes
+        if job.state.get('time_map') is not None:
+            result['audio']['original_duration'] = job.state['original_duration']
+            result['time_map'] = job.state['time_map']
+        
+        with trace_span('response.write', **{'http.response.body.size': file_size}):
+            return jsonify(result)
             
     except BadRequest as e:
         return jsonify({
@@ -173,6 +1344,59 @@ def process_video():
             'error': f'处理失败: {str(e)}'
         }), 500
 
+@app.route('/artifacts/<artifact_id>', methods=['GET'])
+def get_artifact(artifact_id):
+    """下载产物：支持 Range、ETag 和 If-None-Match/If-Modified-Since 条件请求"""
+    meta = ArtifactStore.get(artifact_id)
+    if meta is None or not os.path.exists(ArtifactStore.file_path(meta)):
+        return jsonify({'success': False, 'error': 'Artifact not found'}), 404
+    
+    remaining = int(meta['expires_at'] - time.time())
+    if remaining <= 0:
+        ArtifactStore.remove(meta)
+        return jsonify({'success': False, 'error': 'Artifact expired'}), 410
+    
+    # 内容寻址，ID 即强 ETag；send_file 负责 206/304/416
+    response = send_file(
+        ArtifactStore.file_path(meta),
+        mimetype=meta['content_type'],
+        etag=meta['id'],
+        conditional=True,
+        max_age=remaining,
+        download_name=f'{meta["id"]}.{meta["ext"]}',
+    )
+    response.headers['Expires'] = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(meta['expires_at']))
+    return response
+
+@app.route('/admin/profile', methods=['POST'])
+def profile_worker():
+    """对当前 worker 采样 N 秒调用栈，返回 flamegraph 折叠格式（需 gthread worker 才能观察到并发请求）"""
+    denied = require_admin()
+    if denied:
+        return denied
+    
+    try:
+        seconds = float(request.args.get('seconds', (request.get_json(silent=True) or {}).get('seconds', 10)))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Invalid seconds'}), 400
+    seconds = max(0.1, min(seconds, MAX_PROFILE_SECONDS))
+    
+    logger.info(f'开始采样 worker {os.getpid()}: {seconds}秒')
+    counts = StackSampler.sample(seconds)
+    
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'success': True,
+            'pid': os.getpid(),
+            'seconds': seconds,
+            'interval': PROFILE_INTERVAL,
+            'samples': sum(counts.values()),
+            'stacks': [{'stack': stack, 'count': count} for stack, count in counts.most_common()],
+        })
+    
+    folded = '\n'.join(f'{stack} {count}' for stack, count in counts.most_common())
+    return folded + '\n', 200, {'Content-Type': 'text/plain; charset=utf-8', 'X-Worker-Pid': str(os.getpid())}
+
 @app.route('/', methods=['GET'])
 def index():
     """首页"""
@@ -182,9 +1406,15 @@ def index():
         'endpoints': {
             '/health': 'Health check',
             '/process': 'Process video (POST)',
+            '/artifacts/<id>': 'Fetch processed audio, supports Range/ETag (GET)',
+            '/admin/profile': 'Sample worker stacks, flamegraph folded output (POST, admin)',
         }
     })
 
+if RECOVER_JOBS:
+    threading.Thread(target=recover_jobs, name='job-recovery', daemon=True).start()
+threading.Thread(target=run_maintenance, name='maintenance', daemon=True).start()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
@@ -3,10 +3,15 @@ Replit 视频处理微服务
 处理视频下载和音频提取，供 Vercel 主服务调用
 """
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, g, has_request_context
+from contextlib import contextmanager
 import yt_dlp
 import subprocess
 import os
+import re
+import json
+import math
+import time
 import uuid
 import tempfile
 import logging
@@ -20,6 +25,207 @@ logging.basicConfig(level=logging.INFO)
 TEMP_DIR = tempfile.gettempdir()
 MAX_VIDEO_DURATION = 60  # 秒
 ALLOWED_DOMAINS = ['douyin.com', 'tiktok.com', 'youtube.com', 'bilibili.com']
+SERVICE_NAME = 'replit-video-service'
+
+trace_logger = logging.getLogger('trace')
+
+class Span:
+    """单个追踪片段，字段与 OpenTelemetry OTLP/JSON 对齐"""
+
+    def __init__(self, name, trace_id, parent_span_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, error=None):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            if error is not None:
+                self.error = str(error)
+
+    @staticmethod
+    def _attribute_value(value):
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,  # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns or time.time_ns()),
+            'attributes': [
+                {'key': k, 'value': self._attribute_value(v)}
+                for k, v in self.attributes.items()
+            ],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_span_id:
+            span['parentSpanId'] = self.parent_span_id
+        return span
+
+
+class Tracer:
+    """请求级追踪：每个请求一棵 span 树，请求结束时以 OTLP/JSON 结构输出一行日志"""
+
+    @staticmethod
+    def start_trace(name, traceparent=None, attributes=None):
+        """开始一次请求追踪，支持 W3C traceparent 透传"""
+        trace_id, parent_id = uuid.uuid4().hex, None
+        if traceparent:
+            parts = traceparent.split('-')
+            if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+                trace_id, parent_id = parts[1], parts[2]
+        root = Span(name, trace_id, parent_id, attributes)
+        g.trace_spans = [root]
+        g.trace_stack = [root]
+        return root
+
+    @staticmethod
+    def start_span(name, **attributes):
+        """开始子 span（无请求上下文时返回 None）"""
+        if not has_request_context() or not getattr(g, 'trace_stack', None):
+            return None
+        parent = g.trace_stack[-1]
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+        g.trace_spans.append(span)
+        g.trace_stack.append(span)
+        return span
+
+    @staticmethod
+    def context():
+        """当前请求的 (span 列表, 栈顶 span)，交给线程池任务挂子 span（无请求上下文时返回 None）"""
+        if not has_request_context() or not getattr(g, 'trace_stack', None):
+            return None
+        return g.trace_spans, g.trace_stack[-1]
+    
+    @staticmethod
+    def start_detached_span(context, name, **attributes):
+        """在没有请求上下文的线程里，以 context 的栈顶 span 为父开始子 span"""
+        if context is None:
+            return None
+        spans, parent = context
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+        spans.append(span)
+        return span
+
+    @staticmethod
+    def end_span(span, error=None):
+        if span is None:
+            return
+        span.end(error)
+        if not has_request_context():
+            return
+        stack = g.trace_stack
+        if span in stack:
+            del stack[stack.index(span):]
+
+    @staticmethod
+    def export():
+        """结束整棵追踪并输出结构化 JSON 日志"""
+        spans = getattr(g, 'trace_spans', None)
+        if not spans:
+            return
+        for span in spans:
+            span.end()
+        trace_logger.info(json.dumps({
+            'resourceSpans': [{
+                'resource': {'attributes': [
+                    {'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}},
+                    {'key': 'process.pid', 'value': {'intValue': str(os.getpid())}},
+                ]},
+                'scopeSpans': [{
+                    'scope': {'name': SERVICE_NAME},
+                    'spans': [span.to_otlp() for span in spans],
+                }],
+            }]
+        }, ensure_ascii=False))
+        g.trace_spans = []
+
+
+@contextmanager
+def trace_span(name, context=None, **attributes):
+    """以 with 语句包裹一段耗时操作；在线程池里执行时传入 Tracer.context() 取得的 context"""
+    if context is None:
+        span = Tracer.start_span(name, **attributes)
+    else:
+        span = Tracer.start_detached_span(context, name, **attributes)
+    try:
+        yield span
+    except Exception as e:
+        Tracer.end_span(span, e)
+        raise
+    Tracer.end_span(span)
+
+
+def redact_command_line(cmd):
+    """命令行脱敏：URL 只保留协议和主机（直链带签名），请求头和 Cookie 的值整体隐去"""
+    parts = []
+    for index, arg in enumerate(cmd):
+        if index and cmd[index - 1] in ('-headers', '-cookies'):
+            arg = '<redacted>'
+        else:
+            match = re.match(r'([a-z][a-z0-9+.-]*://)(?:[^/?#@]*@)?([^/?#]*)', arg, re.I)
+            if match:
+                arg = match.group(1) + match.group(2) + '/<redacted>'
+        parts.append(arg)
+    return ' '.join(parts)
+
+
+def run_subprocess(cmd, trace_context=None, **kwargs):
+    """带追踪的 subprocess.run"""
+    attributes = {'process.command': cmd[0], 'process.command_line': redact_command_line(cmd)}
+    with trace_span('subprocess', trace_context, **attributes) as span:
+        result = subprocess.run(cmd, **kwargs)
+        if span is not None:
+            span.set_attribute('process.exit_code', result.returncode)
+        return result
+
+@app.before_request
+def begin_trace():
+    """为每个请求开启追踪"""
+    g.request_start = time.monotonic()
+    Tracer.start_trace(f'{request.method} {request.path}',
+                       traceparent=request.headers.get('traceparent'),
+                       attributes={'http.request.method': request.method, 'url.path': request.path})
+
+
+@app.after_request
+def finish_trace(response):
+    """回写 traceparent 与 Server-Timing，便于调用方关联"""
+    spans = getattr(g, 'trace_spans', None)
+    if spans:
+        root = spans[0]
+        root.set_attribute('http.response.status_code', response.status_code)
+        if response.status_code >= 500 and root.error is None:
+            root.error = f'HTTP {response.status_code}'
+        response.headers['traceparent'] = f'00-{root.trace_id}-{root.span_id}-01'
+        response.headers['Server-Timing'] = f'total;dur={(time.monotonic() - g.request_start) * 1000:.1f}'
+    return response
+
+
+@app.teardown_request
+def export_trace(error=None):
+    """请求结束时导出追踪日志"""
+    spans = getattr(g, 'trace_spans', None)
+    if spans and error is not None:
+        spans[0].end(error)
+    Tracer.export()
 
 # 确保 FFmpeg 可用
 def check_ffmpeg():
@@ -55,7 +261,8 @@ def health():
 def process_video():
     """
     处理视频：下载并提取音频
-    请求体: { "video_url": "https://..." }
+    请求体: { "video_url": "https://...", "start": 0, "end": 60 }
+    start/end（或 first_seconds）可选，指定时只拉取并转码该时间窗口，长视频也可处理
     返回: 音频文件
     """
     try:
@@ -66,15 +273,25 @@ def process_video():
             return jsonify({"error": "缺少 video_url 参数"}), 400
         
         # 验证 URL 域名
-        if not any(domain in video_url for domain in ALLOWED_DOMAINS):
+        with trace_span('url.check', **{'url.full': video_url}):
+            allowed = any(domain in video_url for domain in ALLOWED_DOMAINS)
+        if not allowed:
             return jsonify({"error": "不支持的视频平台"}), 400
         
+        try:
+            window = parse_window(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
         session_id = str(uuid.uuid4())
         temp_video = os.path.join(TEMP_DIR, f"video_{session_id}.mp4")
         temp_audio = os.path.join(TEMP_DIR, f"audio_{session_id}.mp3")
         
         logging.info(f"开始处理视频: {video_url}")
         
+        if window:
+            return process_window(video_url, window, session_id, temp_audio)
+        
         # 配置 yt-dlp
         ydl_opts = {
             'format': 'best[ext=mp4]/best',
@@ -88,7 +305,7 @@ def process_video():
         }
         
         # 下载视频
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with trace_span('download', **{'url.full': video_url}), yt_dlp.YoutubeDL(ydl_opts) as ydl:
             info = ydl.extract_info(video_url, download=True)
             duration = info.get('duration', 0)
             title = info.get('title', 'Unknown')
@@ -107,7 +324,7 @@ def process_video():
             temp_audio
         ]
         
-        subprocess.run(ffmpeg_cmd, check=True, capture_output=True)
+        run_subprocess(ffmpeg_cmd, check=True, capture_output=True)
         logging.info(f"音频提取完成: {temp_audio}")
         
         # 清理视频文件，保留音频
@@ -115,12 +332,13 @@ def process_video():
             os.remove(temp_video)
         
         # 返回音频文件
-        response = send_file(
-            temp_audio,
-            mimetype='audio/mpeg',
-            as_attachment=True,
-            download_name=f"audio_{session_id}.mp3"
-        )
+        with trace_span('response.write', **{'http.response.body.size': os.path.getsize(temp_audio)}):
+            response = send_file(
+                temp_audio,
+                mimetype='audio/mpeg',
+                as_attachment=True,
+                download_name=f"audio_{session_id}.mp3"
+            )
         
         # 添加元数据到响应头
         response.headers['X-Video-Duration'] = str(duration)
@@ -136,6 +354,87 @@ def process_video():
             "message": str(e)
         }), 500
 
+def parse_window(data):
+    """解析时间窗口参数，未指定返回 None"""
+    if not any(key in data for key in ('start', 'end', 'first_seconds')):
+        return None
+    try:
+        if 'first_seconds' in data:
+            start, end = 0.0, float(data['first_seconds'])
+        else:
+            start = float(data.get('start', 0))
+            end = float(data['end']) if 'end' in data else start + MAX_VIDEO_DURATION
+    except (TypeError, ValueError):
+        raise ValueError("时间窗口参数无效")
+    if not (math.isfinite(start) and math.isfinite(end)) or start < 0 or end <= start:
+        raise ValueError("时间窗口参数无效")
+    if end - start > MAX_VIDEO_DURATION:
+        raise ValueError(f"时间窗口不能超过 {MAX_VIDEO_DURATION} 秒")
+    return start, end
+
+def process_window(video_url, window, session_id, temp_audio):
+    """
+    只处理时间窗口：解析媒体直链后由 FFmpeg 做输入端 seek，
+    通过 HTTP Range 只读取窗口所需的数据，不下载整段视频
+    """
+    start, end = window
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'quiet': True,
+        'no_warnings': True,
+        'cookiefile': 'cookies.txt' if os.path.exists('cookies.txt') else None,
+    }
+    
+    with trace_span('extract', **{'url.full': video_url}), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(video_url, download=False)
+        media_url = info.get('url')
+        # cookies.txt 和提取过程中设置的 Cookie 不在 http_headers 里，按 yt-dlp 自带 ffmpeg 下载器的格式交给 ffmpeg
+        cookies = ''.join(
+            f"{cookie.name}={cookie.value}; path={cookie.path}; domain={cookie.domain};\r\n"
+            for cookie in ydl.cookiejar.get_cookies_for_url(media_url)
+        ) if media_url and media_url.startswith(('http://', 'https://')) else ''
+    duration = info.get('duration', 0)
+    title = info.get('title', 'Unknown')
+    if not media_url:
+        return jsonify({"error": "无法解析媒体直链"}), 500
+    if duration and start >= duration:
+        return jsonify({"error": f"起始时间超出视频时长 ({duration}秒)"}), 400
+    if duration:
+        end = min(end, duration)
+    
+    headers = ''.join(f"{k}: {v}\r\n" for k, v in (info.get('http_headers') or {}).items())
+    ffmpeg_cmd = ['ffmpeg'] + (['-headers', headers] if headers else []) + (['-cookies', cookies] if cookies else []) + [
+        '-seekable', '1',
+        '-ss', str(start),
+        '-t', str(end - start),
+        '-i', media_url,
+        '-vn',
+        '-acodec', 'libmp3lame',
+        '-ab', '128k',
+        '-ar', '44100',
+        '-y',
+        temp_audio
+    ]
+    
+    run_subprocess(ffmpeg_cmd, check=True, capture_output=True)
+    logging.info(f"窗口音频提取完成: {title} [{start}-{end}秒]")
+    
+    with trace_span('response.write', **{'http.response.body.size': os.path.getsize(temp_audio)}):
+        response = send_file(
+            temp_audio,
+            mimetype='audio/mpeg',
+            as_attachment=True,
+            download_name=f"audio_{session_id}.mp3"
+        )
+    
+    response.headers['X-Video-Duration'] = str(duration)
+    response.headers['X-Video-Title'] = title
+    response.headers['X-Session-Id'] = session_id
+    response.headers['X-Window-Start'] = str(start)
+    response.headers['X-Window-End'] = str(end)
+    
+    return response
+
 @app.route('/download', methods=['POST'])
 def download_info():
     """
@@ -155,7 +454,7 @@ def download_info():
             'skip_download': True,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with trace_span('extract', **{'url.full': video_url}), yt_dlp.YoutubeDL(ydl_opts) as ydl:
             info = ydl.extract_info(video_url, download=False)
             
         return jsonify({
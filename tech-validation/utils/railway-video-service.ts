@@ -13,14 +13,41 @@ export interface VideoInfo {
   description: string;
 }
 
+export interface VideoScene {
+  index: number;
+  start: number;
+  end: number;
+  keyframe: {
+    format: string;
+    data: string; // hex string
+  };
+}
+
+/**
+ * 静音压缩后的时间映射：压缩音频中 [start, end) 对应原视频时间 source_start 起
+ */
+export interface TimeMapSegment {
+  start: number;
+  end: number;
+  source_start: number;
+}
+
 export interface ProcessVideoResponse {
   success: boolean;
   video_info?: VideoInfo;
+  job_id?: string;
   audio?: {
     size: number;
     format: string;
-    data: string; // hex string
+    data?: string; // hex string，artifact 模式下不返回
+    artifact_id: string;
+    url: string; // /artifacts/<artifact_id>
+    etag: string;
+    expires_at: number;
+    original_duration?: number;
   };
+  scenes?: VideoScene[];
+  time_map?: TimeMapSegment[];
   error?: string;
 }
 